@@ -0,0 +1 @@
+# Puts backend/ on sys.path, so `python -m pytest backend/tests` works from the repo root too
@@ -1,154 +1,45 @@
-from typing import Dict, Any, List, Optional
-from pydantic import BaseModel
+from typing import Dict, List, Optional
 
+import httpx
 
-class ReasoningEngine:
-    """
-    Handles the cognitive processes of the agent: Intent Classification, 
-    Query Parsing, and Rewriting.
-    """
-
-    def __init__(self, llm_client):
-        self.llm = llm_client
-
-    async def analyze_intent(self, user_query: str, chat_history: List[Dict]) -> Dict[str, Any]:
-        """
-        Determines the user's underlying goal and extracts necessary parameters.
-        
-        Architecture Note:
-        Since we are using Ollama (local models), we should not rely solely on 
-        implicit logic. We must force the model to output valid JSON.
-        
-        Steps:
-        1. Construct a prompt with few-shot examples of intents 
-           (e.g., 'SEARCH', 'SUMMARIZE', 'CALCULATE').
-        2. Define a strict JSON schema for the output.
-        3. Invoke the Ollama model with a low temperature (e.g., 0.1) for deterministic results.
-        4. Validate the output against a Pydantic model to ensure type safety.
-        
-        Returns:
-            dict: Contains 'intent_type' (str) and 'extracted_params' (dict).
-        """
-        pass
-
-    async def optimize_query(self, raw_query: str) -> str:
-        """
-        Rewrites the user's raw query into a format optimized for vector retrieval.
-        
-        Architecture Note:
-        Raw queries often lack context (e.g., "How much is it?"). 
-        This function must resolve coreferences using the chat history before
-        passing the query to the search tool.
-        """
-        pass
-
-
-class ToolRegistry:
-    """
-    Manages available tools and executes them based on the Reasoning Layer's instructions.
-    """
-
-    def __init__(self):
-        # Maps tool names to their executable functions
-        self.tools = {
-            "search": self._search_tool,
-            "summarize": self._summary_tool,
-            "custom": self._custom_logic_tool
-        }
-
-    async def execute_tool(self, tool_name: str, params: Dict[str, Any]) -> str:
-        """
-        Routes the request to the specific tool implementation.
-        
-        Architecture Note:
-        This serves as a dispatcher. It must handle exceptions gracefully. 
-        If a tool fails (e.g., DB timeout), it should return a standardized 
-        error message to the context, allowing the Agent to retry or explain the error.
-        """
-        pass
-
-    async def _search_tool(self, query: str, top_k: int = 3) -> str:
-        """
-        Retrieves relevant documents from the vector database.
-        
-        Design Requirement:
-        1. Convert the 'query' into embeddings (using a local embedding model).
-        2. Query the vector store (e.g., ChromaDB or FAISS).
-        3. Rerank results if necessary (optional for v1).
-        4. Return the raw text chunks as a formatted string.
-        """
-        pass
-
-    async def _summary_tool(self, content: str) -> str:
-        """
-        Summarizes long content into concise insights.
-        
-        Design Requirement:
-        If content length exceeds the local model's context window, 
-        implement a 'Map-Reduce' strategy: chunk the text, summarize chunks, 
-        and then summarize the summaries.
-        """
-        pass
-
-
-class ResponseSynthesizer:
-    """
-    Synthesizes the final response by combining user query, tool outputs, and history.
-    """
-
-    def __init__(self, llm_client):
-        self.llm = llm_client
-
-    async def generate_response(self, 
-                                original_query: str, 
-                                tool_outputs: Dict[str, str], 
-                                intent: str) -> str:
-        """
-        Generates the final natural language response for the user.
-        
-        Architecture Note:
-        This is the 'Augmented Generation' part of RAG.
-        
-        Strategy:
-        1. Construct a system prompt that enforces the persona (Helpful Assistant).
-        2. Inject 'tool_outputs' into the context as 'Evidence'.
-        3. Instruct the model to cite the evidence if applicable.
-        4. Stream the response back to the Vue3 frontend for a better UX 
-           (Server-Sent Events or WebSocket).
-        """
-        pass
+from core.reasoning import ReasoningEngine, IntentType
+from core.tools import VectorStoreManager
+from core.synthesizer import ResponseSynthesizer
 
 
 class AgentWorkflow:
     """
     Orchestrates the flow: Reasoning -> Tool -> Aggregation.
+    Built on the canonical engines in core/ (the same classes main.py serves).
     """
-    
-    def __init__(self):
-        self.reasoning = ReasoningEngine(...)
-        self.tools = ToolRegistry(...)
-        self.synthesizer = ResponseSynthesizer(...)
 
-    async def run(self, user_input: str):
+    def __init__(self, ollama_base_url: str, client: httpx.AsyncClient):
+        self.reasoning = ReasoningEngine(ollama_base_url=ollama_base_url, client=client)
+        self.vectors = VectorStoreManager(ollama_base_url=ollama_base_url, http_client=client)
+        self.synthesizer = ResponseSynthesizer(ollama_base_url=ollama_base_url, client=client)
+
+    async def run(self, user_input: str, chat_history: Optional[List[Dict]] = None) -> str:
+        chat_history = chat_history or []
+
         # Step 1: Reason
-        decision = await self.reasoning.analyze_intent(user_input)
-        
+        analysis = await self.reasoning.analyze_query(user_input, chat_history)
+
         # Step 2: Act (Tool Execution)
         # Using specific English comment here:
         # "Execute tool logic only if the intent requires external data.
         # Otherwise, skip to generation (e.g., for chitchat)."
         tool_result = ""
-        if decision['intent'] != 'general_chat':
-            tool_result = await self.tools.execute_tool(
-                decision['intent'], 
-                decision['params']
-            )
-            
+        if analysis.intent == IntentType.SEARCH:
+            tool_result = await self.vectors.search(analysis.rewritten_query or user_input)
+
         # Step 3: Aggregate
-        final_answer = await self.synthesizer.generate_response(
-            user_input, 
-            tool_result, 
-            decision['intent']
-        )
-        
-        return final_answer
\ No newline at end of file
+        tokens = [
+            token async for token in self.synthesizer.generate_response_stream(
+                user_query=user_input,
+                tool_output=tool_result,
+                intent=analysis.intent,
+                chat_history=chat_history
+            )
+        ]
+
+        return "".join(tokens)
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is optional; fall back to the in-process store
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+class LLMCache:
+    """
+    Exact-match cache for Ollama calls, keyed on SHA-256(model + request payload).
+    Uses Redis when a URL is configured, otherwise an in-process LRU with TTL.
+    Values must be JSON-serializable.
+    """
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = 3600, max_size: int = 2048):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                logger.warning("REDIS_URL is set but the redis package is missing, using in-process cache.")
+            else:
+                self._redis = aioredis.from_url(redis_url)
+
+    @staticmethod
+    def make_key(model: str, payload: Any) -> str:
+        return hashlib.sha256(f"{model}:{json.dumps(payload, sort_keys=True)}".encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(f"llm:{key}")
+                return json.loads(raw) if raw is not None else None
+            except Exception as e:
+                logger.warning("Redis cache error: %s", e)
+                return None
+
+        entry = self._local.get(key)
+        if entry is None: return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any):
+        if self._redis is not None:
+            try:
+                await self._redis.set(f"llm:{key}", json.dumps(value), ex=self.ttl)
+            except Exception as e:
+                logger.warning("Redis cache error: %s", e)
+            return
+
+        self._local[key] = (time.monotonic() + self.ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
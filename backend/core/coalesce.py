@@ -0,0 +1,83 @@
+import asyncio
+from typing import AsyncIterator, Callable, List, Optional
+
+_END = object()
+
+class StreamFanout:
+    """
+    Runs a single async token source in a background task and replays it to
+    any number of subscribers. Late subscribers first receive the tokens
+    already produced, then follow the live stream. The source is cancelled
+    once every subscriber has gone away.
+
+    `on_close` runs exactly once, as soon as the fanout stops accepting new
+    subscribers (the source finished, or the last subscriber left); owners use
+    it to drop the fanout from their in-flight map. A source that is cancelled
+    ends every remaining subscriber with an error, never a clean end, so a
+    truncated stream cannot pass for a complete one.
+    """
+    def __init__(self, source: AsyncIterator[str], on_close: Optional[Callable[[], None]] = None):
+        self._source = source
+        self._on_close = on_close
+        self._tokens: List[str] = []
+        self._queues: List[asyncio.Queue] = []
+        self._error: Optional[BaseException] = None
+        self._done = False
+        self.closed = False
+        self._task = asyncio.create_task(self._pump())
+        # A callback rather than a finally: it also runs if the task is cancelled before it starts
+        self._task.add_done_callback(self._finish)
+
+    async def _pump(self):
+        try:
+            async for token in self._source:
+                self._tokens.append(token)
+                for queue in self._queues:
+                    queue.put_nowait(token)
+        except Exception as e:
+            self._error = e
+
+    def _finish(self, task: asyncio.Task):
+        if task.cancelled() and self._error is None:
+            self._error = RuntimeError("Stream was cancelled before it finished.")
+        self._done = True
+        self._detach()
+        for queue in self._queues:
+            queue.put_nowait(_END)
+
+    def _detach(self):
+        if self.closed: return
+        self.closed = True
+        if self._on_close is not None:
+            self._on_close()
+
+    def cancel(self):
+        """Stops the source; detaches immediately so nobody joins while the cancel is pending."""
+        self._detach()
+        self._task.cancel()
+
+    def subscribe(self) -> AsyncIterator[str]:
+        """
+        Registers the subscriber right away, not on first iteration, so a
+        subscriber leaving in the meantime cannot cancel the source under it.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for token in self._tokens:
+            queue.put_nowait(token)
+        if self._done:
+            queue.put_nowait(_END)
+        self._queues.append(queue)
+        return self._follow(queue)
+
+    async def _follow(self, queue: asyncio.Queue) -> AsyncIterator[str]:
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END: break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._queues.remove(queue)
+            if not self._queues and not self._done:
+                self.cancel()
@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+class EmbeddingCache:
+    """
+    Process-wide LRU + TTL cache of embeddings keyed by SHA-256 of the text.
+    Vectors stay as in-memory lists (no serialization). Concurrent misses for
+    the same text share one computation instead of each calling Ollama.
+    """
+    def __init__(self, max_size: int = 10_000, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = self.make_key(text)
+        entry = self._entries.get(key)
+        if entry is None: return None
+        expires_at, embedding = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return embedding
+
+    def put(self, text: str, embedding: List[float]):
+        if not embedding: return
+        key = self.make_key(text)
+        self._entries[key] = (time.monotonic() + self.ttl, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute_many(self, texts: List[str], compute_fn: Callable[[List[str]], Awaitable[List[List[float]]]]) -> List[List[float]]:
+        """
+        Cached texts are answered directly, texts another caller is already
+        embedding wait for that result, and only the rest go to `compute_fn`
+        (in one call). `compute_fn` returns one vector per text, empty on failure.
+        """
+        pending: List[Optional[asyncio.Future]] = []
+        results: List[List[float]] = []
+        owned: Dict[str, asyncio.Future] = {}
+        loop = asyncio.get_running_loop()
+        for text in texts:
+            cached = self.get(text)
+            if cached is not None:
+                results.append(cached)
+                pending.append(None)
+                continue
+            key = self.make_key(text)
+            future = self._inflight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._inflight[key] = future
+                owned[text] = future
+            results.append([])
+            pending.append(future)
+
+        if owned:
+            # Shield so one caller cancelling does not cancel the request for the others
+            await asyncio.shield(asyncio.ensure_future(self._compute(owned, compute_fn)))
+        for i, future in enumerate(pending):
+            if future is not None:
+                results[i] = await asyncio.shield(future)
+        return results
+
+    async def _compute(self, owned: Dict[str, asyncio.Future], compute_fn: Callable[[List[str]], Awaitable[List[List[float]]]]):
+        texts = list(owned)
+        embeddings: List[List[float]] = []
+        try:
+            embeddings = await compute_fn(texts)
+        finally:
+            for i, text in enumerate(texts):
+                embedding = embeddings[i] if i < len(embeddings) else []
+                self._inflight.pop(self.make_key(text), None)
+                self.put(text, embedding)
+                if not owned[text].done():
+                    owned[text].set_result(embedding)
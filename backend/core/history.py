@@ -0,0 +1,56 @@
+import re
+from functools import lru_cache
+from typing import Dict, List
+
+# Rough token estimate; close enough for budgeting prefill without a tokenizer dependency
+CHARS_PER_TOKEN = 4
+KEEP_VERBATIM_MESSAGES = 4  # last 2 turns (user + assistant)
+LONG_MESSAGE_TOKENS = 400
+SUMMARY_CHARS = 200
+
+CHAT_ROLES = ("user", "assistant", "tool")
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s")
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+@lru_cache(maxsize=1024)
+def summarize_message(content: str) -> str:
+    """
+    One-line extractive summary of a long message (its first sentence, clipped).
+    Memoized on the message text, so each old turn is only condensed once.
+    """
+    first_line = content.strip().split("\n", 1)[0]
+    first_sentence = _SENTENCE_END.split(first_line, 1)[0]
+    if len(first_sentence) > SUMMARY_CHARS:
+        first_sentence = first_sentence[:SUMMARY_CHARS].rstrip()
+    return f"{first_sentence} [...]"
+
+def compress_history(history: List[Dict], max_tokens: int = 1500) -> List[Dict]:
+    """
+    Shrinks chat history before it is sent to the model:
+    - keeps only chat roles with their role/content (drops UI-only fields such as image previews)
+    - drops tool outputs older than the last 2 turns
+    - condenses older assistant messages above LONG_MESSAGE_TOKENS to a one-line summary
+    - drops the oldest messages until the estimated total fits max_tokens
+    """
+    messages = [
+        {"role": m["role"], "content": str(m.get("content") or "")}
+        for m in history
+        if m.get("role") in CHAT_ROLES
+    ]
+
+    recent_start = max(len(messages) - KEEP_VERBATIM_MESSAGES, 0)
+    compressed = []
+    for i, m in enumerate(messages):
+        if i < recent_start:
+            if m["role"] == "tool":
+                continue
+            if m["role"] == "assistant" and estimate_tokens(m["content"]) > LONG_MESSAGE_TOKENS:
+                m = {"role": "assistant", "content": summarize_message(m["content"])}
+        compressed.append(m)
+
+    total = sum(estimate_tokens(m["content"]) for m in compressed)
+    while len(compressed) > 1 and total > max_tokens:
+        total -= estimate_tokens(compressed.pop(0)["content"])
+    return compressed
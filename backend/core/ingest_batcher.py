@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from core.tools import VectorStoreManager
+
+logger = logging.getLogger(__name__)
+
+class IngestBatcher:
+    """
+    Coalesces concurrent /ingest calls into one add_documents() call: the
+    worker collects up to `max_batch` documents or waits `flush_interval`
+    seconds, whichever comes first, so a burst of uploads shares a single
+    embedding request and a single set of index writes. If a batch fails,
+    its documents are retried one by one so each caller gets its own error.
+    """
+    def __init__(self, vector_store: VectorStoreManager, max_batch: int = 64, flush_interval: float = 0.05):
+        self.vector_store = vector_store
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: "asyncio.Queue[Tuple[str, Dict, asyncio.Future]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None: return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Server is shutting down."))
+
+    async def submit(self, text: str, metadata: Dict):
+        """Queues one document and waits until it has been indexed (or failed)."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, metadata, future))
+        await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[str, Dict, asyncio.Future]]):
+        # Callers that disconnected while queued no longer need their document
+        batch = [item for item in batch if not item[2].done()]
+        if not batch: return
+
+        try:
+            await self.vector_store.add_documents(
+                documents=[text for text, _, _ in batch],
+                metadatas=[metadata for _, metadata, _ in batch]
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch[0][2], e)
+                return
+            logger.warning("Batch of %d failed, retrying documents individually. Details: %s", len(batch), e)
+            for text, metadata, future in batch:
+                try:
+                    await self.vector_store.add_documents(documents=[text], metadatas=[metadata])
+                    self._resolve(future)
+                except Exception as item_error:
+                    self._resolve(future, item_error)
+            return
+
+        for _, _, future in batch:
+            self._resolve(future)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, error: Optional[Exception] = None):
+        if future.done(): return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
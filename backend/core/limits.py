@@ -0,0 +1,55 @@
+from typing import Any
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+class Slot:
+    """One admitted request; release() is idempotent."""
+    __slots__ = ("_limit", "_released")
+
+    def __init__(self, limit: "ConcurrencyLimit"):
+        self._limit = limit
+        self._released = False
+
+    def release(self):
+        if self._released: return
+        self._released = True
+        self._limit.active -= 1
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    Keeps its slot taken until the response has been sent and releases it
+    however sending ends (completion, error, or a client that disconnected
+    before the body was ever iterated).
+    """
+    def __init__(self, content: Any, slot: Slot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+class ConcurrencyLimit:
+    """
+    Admission control in front of Ollama: at most `limit` requests in flight,
+    and anything beyond that is refused immediately with 429 + Retry-After
+    rather than queued, so overload shows up as fast rejections instead of
+    timeouts piling up behind the model.
+    """
+    def __init__(self, limit: int, retry_after: int = 1):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.active = 0
+
+    def acquire(self) -> Slot:
+        if self.active >= self.limit:
+            raise HTTPException(
+                status_code=429,
+                detail="Server is busy, please retry shortly.",
+                headers={"Retry-After": str(self.retry_after)}
+            )
+        self.active += 1
+        return Slot(self)
@@ -0,0 +1,35 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Request paths only put records on a queue; a QueueListener thread does the
+    actual (blocking) stderr writes. LOG_LEVEL sets the root level (default
+    INFO; use WARNING in production to drop per-request lines). Idempotent, so
+    importing main twice (`python main.py`) does not start a second listener.
+    """
+    global _listener
+    if _listener is not None: return _listener
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    # httpx logs every Ollama call at INFO; keep that off the hot path unless debugging
+    if root.level > logging.DEBUG:
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(_listener.stop)
+    return _listener
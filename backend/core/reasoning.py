@@ -1,8 +1,16 @@
-import json
+import logging
+import re
 import httpx
-from typing import Optional, List, Dict, Any
+import orjson
+from typing import Optional, List, Dict, Any, Tuple
 from enum import Enum
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+
+from core.cache import LLMCache
+from core.history import compress_history
+from core.resilience import ollama_breaker, ollama_retry
+
+logger = logging.getLogger(__name__)
 
 class IntentType(str, Enum):
     SEARCH = "search"
@@ -11,51 +19,211 @@ class IntentType(str, Enum):
     CHITCHAT = "chitchat"
     VISION_QA = "vision_qa"
 
-class QueryAnalysis(BaseModel):
-    intent: IntentType = Field(..., description="The classified intent.")
+class QueryDetails(BaseModel):
+    """Fields the entity-extraction pass returns; the intent comes from the routing pass."""
+    model_config = ConfigDict(extra="ignore")
+
     key_entities: List[str] = Field(default_factory=list)
     missing_info: Optional[str] = Field(None)
     is_safe: bool = Field(True)
+    rewritten_query: Optional[str] = Field(None, description="Standalone query with coreferences resolved.")
+
+class QueryAnalysis(QueryDetails):
+    intent: IntentType = Field(..., description="The classified intent.")
+    # Set on fallbacks built after a failed call; those must not be cached
+    _degraded: bool = PrivateAttr(False)
+
+class FastIntentRouter:
+    """
+    Sub-millisecond keyword classifier for obvious queries (greetings, bare
+    arithmetic, explicit lookups). Returns (intent, confidence); anything it
+    is unsure about gets (None, 0.0) and should go to the LLM.
+    """
+    CHITCHAT_PATTERN = re.compile(
+        r"^(hi|hello|hey|yo|thanks|thank you|thx|ok|okay|bye|goodbye|"
+        r"good (morning|afternoon|evening|night)|你好|您好|謝謝|谢谢|再見|再见)[\s!.?~。！？]*$"
+    )
+    # "12 * (3 + 4)", "what is 2^10?": only digits, operators and brackets...
+    ARITHMETIC_PATTERN = re.compile(r"^(?:(?:what is|what's|calculate|compute)\s+)?[\d\s+\-*/^%().]+[\s=?]*$")
+    # ...with an operator between two operands ("-5" alone is just a number)
+    OPERATION_PATTERN = re.compile(r"[\d)]\s*[+\-*/^%]\s*[\d(]")
+    # Dates and phone numbers use the same characters: 2024-01-15, 1/2/2024, (555) 123-4567
+    NOT_ARITHMETIC_PATTERN = re.compile(r"\d+([-/.])\d+\1\d+|^\(\d{3}\)\s*\d{3}-\d{4}$")
+    SEARCH_PATTERN = re.compile(r"\b(search|find|look up|lookup)\b")
+    # "what is X" is usually a lookup, but "who are you" / "what is your name" is chitchat,
+    # so these openers only hint at SEARCH and leave the decision to the LLM
+    QUESTION_PATTERN = re.compile(r"^(what|who) (is|are|was|were)\b")
+    # A bare pronoun means the subject lives in the chat history, which only the LLM can resolve
+    PRONOUN_PATTERN = re.compile(r"\b(it|its|this|that|these|those|they|them|he|she|him|her)\b")
+
+    def __init__(self, threshold: float = 0.8):
+        self.threshold = threshold
+
+    def classify(self, user_query: str) -> Tuple[Optional[IntentType], float]:
+        text = user_query.strip().lower()
+        if self.CHITCHAT_PATTERN.match(text):
+            return IntentType.CHITCHAT, 0.95
+        if (self.ARITHMETIC_PATTERN.match(text) and self.OPERATION_PATTERN.search(text)
+                and not self.NOT_ARITHMETIC_PATTERN.search(text)):
+            return IntentType.CALCULATE, 0.95
+        if self.SEARCH_PATTERN.search(text):
+            if self.PRONOUN_PATTERN.search(text):
+                return IntentType.SEARCH, 0.5
+            return IntentType.SEARCH, 0.9
+        if self.QUESTION_PATTERN.search(text):
+            return IntentType.SEARCH, 0.6
+        return None, 0.0
+
+# Small routing model; must be pulled on the Ollama host (`ollama pull <model>`)
+DEFAULT_REASONING_MODEL = "llama3.2:1b-instruct-q4_K_M"
 
 class ReasoningEngine:
-    def __init__(self, ollama_base_url: str, model_name: str = "llama3.1:8b-instruct-q5_K_M"):
+    def __init__(self, ollama_base_url: str, client: httpx.AsyncClient, reasoning_model: str = DEFAULT_REASONING_MODEL, model_name: str = "llama3.1:8b-instruct-q5_K_M", cache: Optional[LLMCache] = None):
         self.base_url = ollama_base_url.rstrip("/")
+        # Routing is a small-model task; the 8B is only the escalation target
+        self.reasoning_model = reasoning_model
         self.default_model = model_name # Keep default as backup
-        self.client = httpx.AsyncClient(timeout=300.0)
+        self.client = client
+        self.cache = cache
+        self.fast_router = FastIntentRouter()
+
+        # Built once so every call sends a byte-identical prefix and Ollama can reuse its KV cache
+        self._valid_intents = [e.value for e in IntentType if e != IntentType.VISION_QA]
+        self._intent_system_prompt = (
+            "You are the Reasoning Engine. Classify the user's latest query. "
+            f"Reply with exactly one word from: {', '.join(self._valid_intents)}."
+        )
+        self._extract_system_prompt = (
+            "You are the Reasoning Engine. Output raw JSON only: one object with "
+            "key_entities, rewritten_query (the user's query as a standalone "
+            "question, resolving coreferences using the chat history), missing_info "
+            "(null unless the query cannot be answered without more details) and "
+            "is_safe (false only for harmful requests)."
+        )
 
     async def analyze_query(self, user_query: str, chat_history: List[Dict], has_image: bool = False, model_name: str = None) -> QueryAnalysis:
         if has_image:
             return QueryAnalysis(intent=IntentType.VISION_QA, key_entities=[])
+
+        # Skip the LLM entirely when the keyword router is confident
+        fast_intent, confidence = self.fast_router.classify(user_query)
+        if fast_intent is not None and confidence >= self.fast_router.threshold:
+            return QueryAnalysis(intent=fast_intent, rewritten_query=user_query)
         
-        # Use provided model or fallback to default
-        target_model = model_name if model_name else self.default_model
+        # Use provided model or fallback to the small reasoning model
+        target_model = model_name if model_name else self.reasoning_model
+        history = compress_history(chat_history)[-3:]
+
+        # Low temperature makes the analysis effectively deterministic, so it is safe to cache
+        cache_key = LLMCache.make_key(target_model, {"history": history, "query": user_query})
+        if self.cache:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return QueryAnalysis.model_validate(cached)
+
+        used_model = target_model
+        try:
+            analysis = await self._analyze(user_query, history, target_model)
+        except Exception as e:
+            if target_model == self.default_model:
+                logger.warning("Analysis failed using model %s. Details: %s", target_model, e)
+                return QueryAnalysis(intent=IntentType.CHITCHAT)
+            # Includes a small model that was never pulled (404, not retried): the larger one may still work
+            logger.warning("Analysis failed using model %s, escalating to %s. Details: %s", target_model, self.default_model, e)
+            used_model = self.default_model
+            try:
+                analysis = await self._analyze(user_query, history, self.default_model)
+            except Exception as e:
+                logger.warning("Analysis failed using model %s. Details: %s", self.default_model, e)
+                return QueryAnalysis(intent=IntentType.CHITCHAT)
+
+        # Cascade: let the larger model re-check anything the small one flagged
+        if (analysis.missing_info or not analysis.is_safe) and used_model != self.default_model:
+            logger.info("Escalating to %s", self.default_model)
+            try:
+                analysis = await self._analyze(user_query, history, self.default_model)
+            except Exception as e:
+                logger.warning("Escalation failed, keeping %s result. Details: %s", target_model, e)
 
-        system_prompt = (
-            "You are the Reasoning Engine. Output raw JSON only. "
-            f"Valid Intents: {[e.value for e in IntentType]}"
+        # A transient failure must not pin the un-rewritten query for the whole TTL
+        if self.cache and not analysis._degraded:
+            await self.cache.set(cache_key, analysis.model_dump(mode="json"))
+        return analysis
+
+    async def _analyze(self, user_query: str, chat_history: List[Dict], target_model: str) -> QueryAnalysis:
+        intent = await self._classify_intent(user_query, chat_history, target_model)
+        # Only retrieval needs entities and a standalone query; skip the second pass otherwise
+        if intent == IntentType.SEARCH:
+            return await self._extract_search_details(user_query, chat_history, target_model)
+        return QueryAnalysis(intent=intent)
+
+    async def _classify_intent(self, user_query: str, chat_history: List[Dict], target_model: str) -> IntentType:
+        """
+        Asks for a single intent word instead of a JSON object: a handful of
+        output tokens, and nothing for a quantized model to mis-format.
+        """
+        history_lines = [f"{m['role'].capitalize()}: {m['content']}" for m in chat_history]
+        prompt = "\n".join([*history_lines, f"Query: {user_query}", "Intent:"])
+
+        response = await self._post(
+            "/api/generate",
+            {
+                "model": target_model,
+                "system": self._intent_system_prompt,
+                "prompt": prompt,
+                "stream": False,
+                "keep_alive": "30m",
+                "options": {
+                    "temperature": 0,
+                    "num_predict": 4,
+                    "num_ctx": 4096,
+                    "stop": ["\n"]
+                }
+            }
         )
+        match = re.search(r"[a-z_]+", orjson.loads(response.content).get("response", "").lower())
+        if match and match.group(0) in self._valid_intents:
+            return IntentType(match.group(0))
+        return IntentType.CHITCHAT
+
+    async def _extract_search_details(self, user_query: str, chat_history: List[Dict], target_model: str) -> QueryAnalysis:
         messages = [
-            {"role": "system", "content": system_prompt},
-            *chat_history[-3:],
+            {"role": "system", "content": self._extract_system_prompt},
+            *chat_history,
             {"role": "user", "content": f"Analyze: {user_query}"}
         ]
-        
         try:
-            response = await self.client.post(
-                f"{self.base_url}/api/chat",
-                json={
+            response = await self._post(
+                "/api/chat",
+                {
                     "model": target_model,
                     "messages": messages,
                     "format": "json",
                     "stream": False,
-                    "options": {"temperature": 0.1}
+                    "keep_alive": "30m",
+                    # The entity object is tiny; a hard cap stops the model rambling past it
+                    "options": {
+                        "temperature": 0.1,
+                        "num_predict": 128,
+                        "num_ctx": 4096,
+                        "stop": ["</s>", "<|eot_id|>"]
+                    }
                 }
             )
-            response.raise_for_status()
-            return QueryAnalysis.model_validate_json(response.json().get("message", {}).get("content", "{}"))
+            # Decode the envelope once, then let pydantic-core parse the model's JSON directly
+            content = orjson.loads(response.content).get("message", {}).get("content", "{}")
+            details = QueryDetails.model_validate_json(content.encode())
+            return QueryAnalysis(intent=IntentType.SEARCH, **dict(details))
         except Exception as e:
-            print(f"[Reasoning Error] Using model {target_model}. Details: {e}")
-            return QueryAnalysis(intent=IntentType.CHITCHAT)
+            # The intent is already known; searching with the raw query beats falling back to chitchat
+            logger.warning("Entity extraction failed, using raw query. Details: %s", e)
+            fallback = QueryAnalysis(intent=IntentType.SEARCH, rewritten_query=user_query)
+            fallback._degraded = True
+            return fallback
 
-    async def rewrite_query(self, raw_query: str, history: List[Dict]) -> str:
-        return raw_query
\ No newline at end of file
+    @ollama_retry
+    @ollama_breaker
+    async def _post(self, path: str, payload: Dict[str, Any]) -> httpx.Response:
+        response = await self.client.post(f"{self.base_url}{path}", json=payload)
+        response.raise_for_status()
+        return response
\ No newline at end of file
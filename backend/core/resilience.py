@@ -0,0 +1,84 @@
+import functools
+import time
+from email.utils import parsedate_to_datetime
+import httpx
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from tenacity.wait import wait_base
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Ollama while the circuit breaker is open."""
+
+def is_transient(exc: BaseException) -> bool:
+    """Timeouts, dropped connections, 429 and 5xx are worth retrying; other 4xx are not."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+class CircuitBreaker:
+    """
+    Opens after `fail_max` consecutive transient failures and then fails calls
+    instantly for `reset_timeout` seconds, instead of letting coroutines pile up
+    on a dead host. After the timeout, calls are let through again as probes.
+    """
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 30.0):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Ollama circuit is open; failing fast.")
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if is_transient(e):
+                    self._failures += 1
+                    if self._failures >= self.fail_max:
+                        self._opened_at = time.monotonic()
+                raise
+            self._failures = 0
+            self._opened_at = None
+            return result
+        return wrapper
+
+class wait_retry_after(wait_base):
+    """
+    Sleeps for the server's Retry-After (delta-seconds or HTTP date, capped at
+    `max_wait`) when a 429/503 carries one; otherwise defers to `fallback`.
+    """
+    def __init__(self, fallback: wait_base, max_wait: float = 10.0):
+        self.fallback = fallback
+        self.max_wait = max_wait
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exc, httpx.HTTPStatusError):
+            delay = self._parse(exc.response.headers.get("retry-after"))
+            if delay is not None:
+                return min(max(delay, 0.0), self.max_wait)
+        return self.fallback(retry_state)
+
+    @staticmethod
+    def _parse(value):
+        if not value: return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+# One breaker for the single Ollama host every module talks to
+ollama_breaker = CircuitBreaker()
+
+ollama_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_retry_after(wait_exponential_jitter(initial=0.1, max=2.0)),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
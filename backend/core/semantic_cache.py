@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+
+@dataclass
+class SemanticCacheEntry:
+    intent: str
+    tool_output: str
+    response: str
+    generation: Optional[int]  # knowledge-base generation for search answers, None otherwise
+    expires_at: float
+
+class SemanticCache:
+    """
+    Near-duplicate answer cache: a query whose embedding has cosine similarity
+    >= `threshold` with a cached query reuses that turn's full response.
+    Embeddings live in a preallocated float32 matrix so a lookup is a single
+    matrix-vector product. Entries expire after `ttl` seconds, the least
+    recently used one is evicted when full, and search answers are dropped
+    once `invalidate_search()` bumps the knowledge-base generation.
+    """
+    def __init__(self, threshold: float = 0.95, max_size: int = 1024, ttl: int = 3600):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._matrix: Optional[np.ndarray] = None  # (max_size, dim), rows L2-normalized
+        self._valid = np.zeros(max_size, dtype=bool)
+        self._entries: "OrderedDict[int, SemanticCacheEntry]" = OrderedDict()  # slot -> entry, LRU order
+
+    def _normalize(self, embedding: List[float]) -> Optional[np.ndarray]:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if vec.ndim != 1 or norm == 0: return None
+        if self._matrix is not None and vec.shape[0] != self._matrix.shape[1]: return None
+        return vec / norm
+
+    def _evict(self, slot: int):
+        self._valid[slot] = False
+        self._entries.pop(slot, None)
+
+    def lookup(self, embedding: List[float]) -> Optional[SemanticCacheEntry]:
+        if not self._entries: return None
+        query = self._normalize(embedding)
+        if query is None: return None
+
+        sims = self._matrix @ query
+        sims[~self._valid] = -1.0
+        slot = int(np.argmax(sims))
+        if sims[slot] < self.threshold: return None
+
+        entry = self._entries[slot]
+        stale = entry.generation is not None and entry.generation != self.generation
+        if stale or entry.expires_at < time.monotonic():
+            self._evict(slot)
+            return None
+        self._entries.move_to_end(slot)
+        return entry
+
+    def store(self, embedding: List[float], intent: str, tool_output: str, response: str):
+        vec = self._normalize(embedding)
+        if vec is None: return
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_size, vec.shape[0]), dtype=np.float32)
+
+        free = np.flatnonzero(~self._valid)
+        if free.size:
+            slot = int(free[0])
+        else:
+            slot = next(iter(self._entries))
+            self._evict(slot)
+
+        self._matrix[slot] = vec
+        self._valid[slot] = True
+        self._entries[slot] = SemanticCacheEntry(
+            intent=intent,
+            tool_output=tool_output,
+            response=response,
+            generation=self.generation if intent == "search" else None,
+            expires_at=time.monotonic() + self.ttl,
+        )
+
+    def invalidate_search(self):
+        """Called after ingestion: cached search answers may no longer reflect the knowledge base."""
+        self.generation += 1
+
+    async def record(self, embedding: List[float], intent: str, tool_output: str, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Passes tokens through and stores the full response once the stream completes."""
+        generation = self.generation
+        parts = []
+        async for token in tokens:
+            parts.append(token)
+            yield token
+        # Skip answers whose retrieval may predate an ingest that finished mid-stream
+        if parts and self.generation == generation:
+            self.store(embedding, intent, tool_output, "".join(parts))
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import orjson
+from typing import AsyncIterator, List
+
+logger = logging.getLogger(__name__)
+
+# Stop Nginx and other proxies from buffering the stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
+def _event(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def sse_stream(tokens: AsyncIterator[str], heartbeat: float = 15.0, max_chars: int = 512, flush_interval: float = 0.03) -> AsyncIterator[bytes]:
+    """
+    Frames tokens as SSE `data: {"token": ...}` events and finishes with
+    `data: {"done": true}`. Tokens are coalesced into one event per
+    `flush_interval` seconds (or `max_chars` characters) so a fast model does
+    not cost one ASGI body message per token; a token arriving after a quiet
+    spell is still sent immediately. While the source is silent (e.g. model
+    loading) a `: ping` comment goes out every `heartbeat` seconds to keep
+    proxies from closing the connection. A failing source is reported as an
+    `error` event after whatever was already buffered.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = tokens.__aiter__()
+    pending = None
+    buffer: List[str] = []
+    buffered_chars = 0
+    last_flush = loop.time()
+
+    def flush() -> bytes:
+        nonlocal buffered_chars, last_flush
+        event = _event({"token": "".join(buffer)})
+        buffer.clear()
+        buffered_chars = 0
+        last_flush = loop.time()
+        return event
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, last_flush + flush_interval - loop.time()) if buffer else heartbeat
+            # asyncio.wait (unlike wait_for) leaves the pending read running on timeout
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield flush() if buffer else b": ping\n\n"
+                continue
+            task, pending = pending, None
+            try:
+                token = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                logger.error("Stream failed: %s", e)
+                if buffer:
+                    yield flush()
+                yield _event({"error": str(e)})
+                break
+            buffer.append(token)
+            buffered_chars += len(token)
+            if buffered_chars >= max_chars or loop.time() - last_flush >= flush_interval:
+                yield flush()
+    finally:
+        if pending is not None:
+            pending.cancel()
+    if buffer:
+        yield flush()
+    yield _event({"done": True})
+
+async def text_stream(text: str) -> AsyncIterator[str]:
+    """Single-chunk token source, for canned or error responses."""
+    yield text
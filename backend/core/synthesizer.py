@@ -1,37 +1,115 @@
-import json
+import logging
 import httpx
-from typing import AsyncGenerator, Dict, List
+import orjson
+from typing import AsyncGenerator, Dict, List, Optional
+
+from core.cache import LLMCache
+from core.coalesce import StreamFanout
+from core.history import compress_history
+from core.resilience import ollama_breaker, ollama_retry
+
+logger = logging.getLogger(__name__)
 
 class ResponseSynthesizer:
-    def __init__(self, ollama_base_url: str, model_name: str = "llama3.1:8b-instruct-q5_K_M"):
+    def __init__(self, ollama_base_url: str, client: httpx.AsyncClient, model_name: str = "llama3.1:8b-instruct-q5_K_M", cache: Optional[LLMCache] = None):
         self.base_url = ollama_base_url.rstrip("/")
         self.default_model = model_name
-        self.client = httpx.AsyncClient(timeout=300.0)
+        self.client = client
+        self.cache = cache
+        # Identical prompts already streaming from Ollama; later callers subscribe instead
+        self._inflight: Dict[str, StreamFanout] = {}
 
     async def generate_response_stream(self, user_query: str, tool_output: str, intent: str, chat_history: List[Dict], model_name: str = None) -> AsyncGenerator[str, None]:
         
         target_model = model_name if model_name else self.default_model
         
-        system_instruction = "You are a helpful AI assistant."
         final_prompt = user_query
-        
-        if intent == "search" or intent == "vision_qa":
-            system_instruction += " Use the provided context to answer."
+        if self._uses_context(intent):
             final_prompt = f"--- CONTEXT ---\n{tool_output}\n--- END CONTEXT ---\n\nQuestion: {user_query}"
 
         messages = [
-            {"role": "system", "content": system_instruction},
-            *chat_history[-5:],
+            *self._prefix_messages(intent, chat_history),
             {"role": "user", "content": final_prompt}
         ]
 
-        async with self.client.stream("POST", f"{self.base_url}/api/chat", json={
-            "model": target_model, "messages": messages, "stream": True
-        }) as response:
-            async for line in response.aiter_lines():
-                if not line: continue
-                try:
-                    chunk = json.loads(line)
-                    token = chunk.get("message", {}).get("content", "")
+        cache_key = LLMCache.make_key(target_model, messages)
+        if self.cache:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        fanout = self._inflight.get(cache_key)
+        if fanout is None:
+            fanout = StreamFanout(
+                self._stream_from_ollama(target_model, messages, cache_key),
+                on_close=lambda: self._inflight.pop(cache_key, None)
+            )
+            self._inflight[cache_key] = fanout
+        async for token in fanout.subscribe():
+            yield token
+
+    async def _stream_from_ollama(self, target_model: str, messages: List[Dict], cache_key: str) -> AsyncGenerator[str, None]:
+        tokens = []
+        async for token in self._ollama_tokens(target_model, messages):
+            tokens.append(token)
+            yield token
+        # Only a stream that ran to completion is worth replaying
+        if self.cache and tokens:
+            await self.cache.set(cache_key, "".join(tokens))
+
+    async def _ollama_tokens(self, target_model: str, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        response = await self._open_stream({
+            "model": target_model,
+            "messages": messages,
+            "stream": True,
+            "keep_alive": "30m",
+            "options": {
+                "num_predict": 1024,
+                "num_ctx": 4096,
+                "stop": ["</s>", "<|eot_id|>"]
+            }
+        })
+        try:
+            # Split NDJSON on raw bytes: skips httpx's per-line text decoding
+            buffer = b""
+            async for data in response.aiter_bytes():
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    token = self._parse_token(line)
                     if token: yield token
-                except: continue
\ No newline at end of file
+            token = self._parse_token(buffer)
+            if token: yield token
+        finally:
+            await response.aclose()
+
+    @ollama_retry
+    @ollama_breaker
+    async def _open_stream(self, payload: Dict) -> httpx.Response:
+        """Only opening the stream is retried; tokens already shown to the user are never replayed."""
+        request = self.client.build_request("POST", f"{self.base_url}/api/chat", json=payload)
+        response = await self.client.send(request, stream=True)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _uses_context(intent: str) -> bool:
+        return intent == "search" or intent == "vision_qa"
+
+    def _prefix_messages(self, intent: str, chat_history: List[Dict]) -> List[Dict]:
+        system_instruction = "You are a helpful AI assistant."
+        if self._uses_context(intent):
+            system_instruction += " Use the provided context to answer."
+        return [{"role": "system", "content": system_instruction}, *compress_history(chat_history)[-5:]]
+
+    @staticmethod
+    def _parse_token(line: bytes) -> str:
+        if not line.strip(): return ""
+        try:
+            chunk = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return ""
+        return chunk.get("message", {}).get("content", "")
\ No newline at end of file
@@ -1,16 +1,32 @@
+import asyncio
+import logging
+import os
 import chromadb
 import httpx
+import orjson
 import re
 import base64
+import uuid
 from typing import List, Dict, Optional
 
+from core.embedding_cache import EmbeddingCache
+from core.resilience import ollama_breaker, ollama_retry
+
+logger = logging.getLogger(__name__)
+
+# Mirrors Ollama's own OLLAMA_NUM_PARALLEL so the per-item fallback never
+# queues more embedding requests than the server will run at once.
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+_NEWLINES = re.compile(r'\n+')
+
 class VectorStoreManager:
     """
     Manages the interaction with the Vector Database (ChromaDB) and 
     Embedding Model (Ollama).
     Includes Chunking logic to handle large documents.
     """
-    def __init__(self, ollama_base_url: str, collection_name: str = "knowledge_base", embedding_model: str = "nomic-embed-text:latest"):
+    def __init__(self, ollama_base_url: str, http_client: httpx.AsyncClient, collection_name: str = "knowledge_base", embedding_model: str = "nomic-embed-text:latest", embedding_cache: Optional[EmbeddingCache] = None):
         self.base_url = ollama_base_url.rstrip("/")
         self.embedding_model = embedding_model
         # Persistent path inside container
@@ -20,135 +36,218 @@ class VectorStoreManager:
             name=collection_name, 
             metadata={"hnsw:space": "cosine"}
         )
-        self.http_client = httpx.AsyncClient(timeout=300.0)
+        self.http_client = http_client
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self._embed_semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
 
     def _chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
         """
         Splits text into smaller chunks with overlap to maintain context.
         """
         if not text: return []
-        text = re.sub(r'\n+', '\n', text)
+        text = _NEWLINES.sub('\n', text)
         chunks = []
         start = 0
         text_len = len(text)
 
         while start < text_len:
             end = start + chunk_size
-            if end < text_len:
+            if end >= text_len:
+                end = text_len
+            else:
                 last_space = text.rfind(' ', start, end)
-                if last_space != -1 and last_space > start:
+                if last_space > start:
                     end = last_space
             
             chunk = text[start:end].strip()
             if chunk:
                 chunks.append(chunk)
+            if end == text_len: break
             
-            start = end - overlap
-            if start >= end: start = end
+            # Always move forward, even when the break landed within `overlap` of start
+            next_start = end - overlap
+            start = next_start if next_start > start else end
                 
         return chunks
 
-    async def _get_embedding(self, text: str) -> List[float]:
+    async def _fetch_embedding(self, text: str) -> List[float]:
         try:
-            response = await self.http_client.post(
-                f"{self.base_url}/api/embeddings",
-                json={"model": self.embedding_model, "prompt": text}
-            )
-            response.raise_for_status()
-            return response.json()["embedding"]
+            response = await self._post("/api/embeddings", {"model": self.embedding_model, "prompt": text})
+            return orjson.loads(response.content)["embedding"]
         except Exception as e:
-            print(f"[Embedding Error] {e}")
+            logger.warning("Embedding failed: %s", e)
             return []
 
+    async def _get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds all texts through the cache; concurrent callers asking for the
+        same uncached text share one request. Failed items come back as empty
+        lists so indices stay aligned.
+        """
+        if not texts: return []
+        return await self.embedding_cache.get_or_compute_many(texts, self._fetch_embeddings)
+
+    async def _fetch_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        One /api/embed call for all texts. Older Ollama servers without the
+        batch endpoint fall back to concurrent per-item requests.
+        """
+        try:
+            response = await self._post("/api/embed", {"model": self.embedding_model, "input": texts})
+            embeddings = orjson.loads(response.content)["embeddings"]
+            if len(embeddings) == len(texts):
+                return embeddings
+            logger.warning("Embedding batch returned %d vectors for %d inputs.", len(embeddings), len(texts))
+        except Exception as e:
+            logger.warning("Embedding batch endpoint unavailable, falling back to per-item requests. Details: %s", e)
+
+        async def _guarded(text: str) -> List[float]:
+            async with self._embed_semaphore:
+                return await self._fetch_embedding(text)
+
+        fallback = await asyncio.gather(*[_guarded(text) for text in texts], return_exceptions=True)
+        return [emb if isinstance(emb, list) else [] for emb in fallback]
+
+    @ollama_retry
+    @ollama_breaker
+    async def _post(self, path: str, payload: Dict) -> httpx.Response:
+        response = await self.http_client.post(f"{self.base_url}{path}", json=payload)
+        response.raise_for_status()
+        return response
+
+    async def embed(self, text: str) -> List[float]:
+        """Embedding for a single text (cached); empty list on failure."""
+        return (await self._get_embeddings_batch([text]))[0]
+
     async def search(self, query: str, top_k: int = 3) -> str:
-        query_vec = await self._get_embedding(query)
-        if not query_vec: return "Error generating embeddings."
-        
-        results = self.collection.query(
-            query_embeddings=[query_vec], 
+        return (await self.search_many([query], top_k=top_k))[0]
+
+    async def search_many(self, queries: List[str], top_k: int = 3) -> List[str]:
+        """
+        Embeds all queries in one HTTP call and runs one batched Chroma query.
+        Returns one formatted result string per input query.
+        """
+        if not queries: return []
+        query_vecs = await self._get_embeddings_batch(queries)
+        valid = [i for i, vec in enumerate(query_vecs) if vec]
+        outputs = ["Error generating embeddings."] * len(queries)
+        if not valid: return outputs
+
+        # HNSW traversal is CPU-bound; keep it off the event loop
+        results = await asyncio.to_thread(
+            self.collection.query,
+            query_embeddings=[query_vecs[i] for i in valid], 
             n_results=top_k
         )
-        
-        docs = results.get("documents", [[]])[0]
-        metadatas = results.get("metadatas", [[]])[0]
-        
+
+        all_docs = results.get("documents") or []
+        all_metadatas = results.get("metadatas") or []
+        for row, i in enumerate(valid):
+            docs = all_docs[row] if row < len(all_docs) else []
+            metadatas = all_metadatas[row] if row < len(all_metadatas) else []
+            outputs[i] = self._format_results(docs, metadatas)
+        return outputs
+
+    @staticmethod
+    def _format_results(docs: List[str], metadatas: List[Optional[Dict]]) -> str:
         if not docs: return "No relevant info found in knowledge base."
         
         formatted_results = []
-        for i, (doc, meta) in enumerate(zip(docs, metadatas)):
+        for i, (doc, meta) in enumerate(zip(docs, metadatas or [None] * len(docs))):
             source = meta.get("source", "Unknown") if meta else "Unknown"
             formatted_results.append(f"[Result {i+1}] (Source: {source}):\n{doc}")
             
         return "\n\n".join(formatted_results)
 
     async def add_documents(self, documents: List[str], metadatas: List[Dict]):
+        """
+        Chunks, embeds and stores the documents. Raises RuntimeError, before
+        anything is written, if any document would end up with no stored
+        chunks (empty text or every embedding failed), so callers never report
+        such a document as indexed.
+        """
         all_chunks = []
         all_metadatas = []
         all_ids = []
-        current_count = self.collection.count()
+        all_doc_idx = []
         
-        print(f"[Ingest] Processing {len(documents)} documents...")
+        logger.info("Ingest: processing %d documents...", len(documents))
 
         for idx, doc in enumerate(documents):
             chunks = self._chunk_text(doc)
             original_meta = metadatas[idx] if idx < len(metadatas) else {}
-            print(f"[Ingest] Document {idx+1} split into {len(chunks)} chunks.")
+            logger.debug("Ingest: document %d split into %d chunks.", idx + 1, len(chunks))
+            # Random per-document id: count-based ids collided whenever an earlier
+            # document stored no chunks, and the upsert then overwrote real data
+            doc_id = uuid.uuid4().hex
 
             for chunk_i, chunk in enumerate(chunks):
                 all_chunks.append(chunk)
                 all_metadatas.append(original_meta)
-                all_ids.append(f"doc_{current_count + idx}_chunk_{chunk_i}")
+                all_ids.append(f"doc_{doc_id}_chunk_{chunk_i}")
+                all_doc_idx.append(idx)
 
-        embeddings = []
-        for i, chunk in enumerate(all_chunks):
-            if i % 10 == 0: print(f"[Ingest] Embedding chunk {i+1}/{len(all_chunks)}...")
-            emb = await self._get_embedding(chunk)
-            if emb: embeddings.append(emb)
+        logger.debug("Ingest: embedding %d chunks...", len(all_chunks))
+        embeddings = await self._get_embeddings_batch(all_chunks)
 
-        if not embeddings:
-            print("[Error] No embeddings generated.")
-            return
+        # Drop chunks whose embedding failed so ids/documents/metadatas stay aligned
+        kept = [i for i, emb in enumerate(embeddings) if emb]
+        if len(kept) != len(all_chunks):
+            logger.warning("Ingest: skipping %d chunks without embeddings.", len(all_chunks) - len(kept))
+            all_ids = [all_ids[i] for i in kept]
+            all_chunks = [all_chunks[i] for i in kept]
+            all_metadatas = [all_metadatas[i] for i in kept]
+            embeddings = [embeddings[i] for i in kept]
+
+        stored_docs = {all_doc_idx[i] for i in kept}
+        empty_docs = [idx + 1 for idx in range(len(documents)) if idx not in stored_docs]
+        if empty_docs:
+            raise RuntimeError(f"No chunks could be stored for document(s) {empty_docs} (empty text or embedding failed).")
 
         batch_size = 100
         total_chunks = len(embeddings) # Use embeddings length to be safe
         
         for i in range(0, total_chunks, batch_size):
             end = min(i + batch_size, total_chunks)
-            self.collection.upsert(
+            await asyncio.to_thread(
+                self.collection.upsert,
                 ids=all_ids[i:end], 
                 documents=all_chunks[i:end], 
                 embeddings=embeddings[i:end], 
                 metadatas=all_metadatas[i:end]
             )
-        print(f"[Info] Successfully added {total_chunks} chunks to vector store.")
+        logger.info("Successfully added %d chunks to vector store.", total_chunks)
 
 class VisionTool:
     """
     Provides visual capabilities using Multimodal LLMs.
     """
-    def __init__(self, ollama_base_url: str, model_name: str = "llama3.2-vision:latest"):
+    def __init__(self, ollama_base_url: str, client: httpx.AsyncClient, model_name: str = "llama3.2-vision:latest"):
         self.base_url = ollama_base_url.rstrip("/")
         self.model = model_name
-        self.client = httpx.AsyncClient(timeout=300.0)
+        self.client = client
 
-    async def analyze_image(self, image_base64: str, prompt: str) -> str:
+    async def analyze_image(self, image_bytes: bytes, prompt: str) -> str:
         try:
-            if "," in image_base64: 
-                image_base64 = image_base64.split(",")[1]
-                
-            response = await self.client.post(
-                f"{self.base_url}/api/chat",
-                json={
-                    "model": self.model,
-                    "messages": [{
-                        "role": "user", 
-                        "content": prompt, 
-                        "images": [image_base64]
-                    }],
-                    "stream": False
-                }
-            )
-            return response.json().get("message", {}).get("content", "")
+            # Ollama wants base64; encode exactly once, right before the request, off the event loop
+            image_base64 = (await asyncio.to_thread(base64.b64encode, image_bytes)).decode()
+            response = await self._post("/api/chat", {
+                "model": self.model,
+                "messages": [{
+                    "role": "user", 
+                    "content": prompt, 
+                    "images": [image_base64]
+                }],
+                "stream": False
+            })
+            return orjson.loads(response.content).get("message", {}).get("content", "")
         except Exception as e:
-            print(f"[Vision Error] {e}")
-            return "Error analyzing image."
\ No newline at end of file
+            logger.warning("Vision analysis failed: %s", e)
+            return "Error analyzing image."
+
+    @ollama_retry
+    @ollama_breaker
+    async def _post(self, path: str, payload: Dict) -> httpx.Response:
+        response = await self.client.post(f"{self.base_url}{path}", json=payload)
+        response.raise_for_status()
+        return response
\ No newline at end of file
@@ -1,11 +1,28 @@
 # Assuming you are using FastAPI for your Python backend
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 
-app = FastAPI()
+from core.synthesizer import ResponseSynthesizer
+from core.streaming import SSE_HEADERS, sse_stream
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One process-wide client: keep-alive connections to Ollama stay hot and
+    # HTTP/2 lets concurrent requests share a single socket.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=300,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    # Instantiate our modules (Singleton pattern usually)
+    app.state.synthesizer = ResponseSynthesizer(ollama_base_url="http://192.168.1.230:11434", client=app.state.http)
+    yield
+    await app.state.http.aclose()
 
-# Instantiate our modules (Singleton pattern usually)
-synthesizer = ResponseSynthesizer(ollama_base_url="http://192.168.1.230:11434")
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/chat/stream")
 async def chat_endpoint(request: Request):
@@ -20,12 +37,12 @@ async def chat_endpoint(request: Request):
     history = data.get("history", [])
 
     # Create the generator
-    response_generator = synthesizer.generate_response_stream(
+    response_generator = request.app.state.synthesizer.generate_response_stream(
         user_query=user_query,
         tool_output=tool_output,
         intent=intent,
         chat_history=history
     )
 
-    # Return as Event Stream
-    return StreamingResponse(response_generator, media_type="text/event-stream")
\ No newline at end of file
+    # Return as Event Stream (SSE-framed, proxy buffering disabled)
+    return StreamingResponse(sse_stream(response_generator), media_type="text/event-stream", headers=SSE_HEADERS)
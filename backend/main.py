@@ -1,131 +1,433 @@
 import os
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+import httpx
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 # Import custom modules
-from core.reasoning import ReasoningEngine, IntentType
+from core.reasoning import DEFAULT_REASONING_MODEL, ReasoningEngine, IntentType
 from core.tools import VectorStoreManager, VisionTool
 from core.synthesizer import ResponseSynthesizer
+from core.cache import LLMCache
+from core.coalesce import StreamFanout
+from core.embedding_cache import EmbeddingCache
+from core.ingest_batcher import IngestBatcher
+from core.limits import ConcurrencyLimit, Slot, SlotStreamingResponse
+from core.semantic_cache import SemanticCache
+from core.streaming import SSE_HEADERS, sse_stream, text_stream
+from core.logging_setup import setup_logging
+
+# Configured before anything logs; LOG_LEVEL picks the verbosity
+setup_logging()
+logger = logging.getLogger("main")
 
 # --- Configuration ---
 # [CRITICAL FIX] .rstrip("/") ensures we never have double slashes (//) in the URL
 OLLAMA_BASE_URL = os.getenv("OLLAMA_HOST", "http://10.199.1.230:8082").rstrip("/")
 
-print(f"[System Config] OLLAMA_BASE_URL is set to: {OLLAMA_BASE_URL}")
-
-# --- FastAPI Setup ---
-app = FastAPI(title="Agentic RAG API", version="1.0.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# --- Global Instances ---
-reasoning_engine = None
-vector_store = None
-vision_tool = None
-synthesizer = None
+logger.info("OLLAMA_BASE_URL is set to: %s", OLLAMA_BASE_URL)
 
 # --- API Models ---
 class ChatRequest(BaseModel):
     query: str
     history: List[Dict[str, str]] = Field(default_factory=list)
-    image_data: Optional[str] = Field(None, description="Base64 encoded image string")
+    image_data: Optional[str] = None  # base64, optionally as a data URL
+
+# Multipart history arrives as a JSON string; validate it exactly like ChatRequest.history
+_HISTORY_ADAPTER = TypeAdapter(List[Dict[str, str]])
 
 class IngestRequest(BaseModel):
     text_content: str
     metadata: Dict[str, Any]
 
-# --- Startup Event ---
-@app.on_event("startup")
-async def startup_event():
-    global reasoning_engine, vector_store, vision_tool, synthesizer
-    print(f"[System] Connecting to Ollama at {OLLAMA_BASE_URL}...")
+# --- Shared Engines ---
+@dataclass
+class ChatEngines:
+    """The long-lived objects a chat turn needs; built once at startup, kept on app.state."""
+    reasoning: ReasoningEngine
+    vector_store: VectorStoreManager
+    vision: VisionTool
+    synthesizer: ResponseSynthesizer
+    semantic_cache: SemanticCache
+    inflight: Dict[str, StreamFanout] = field(default_factory=dict)  # single-flight key -> running turn
+
+def get_chat_engines(request: Request) -> ChatEngines:
+    return request.app.state.engines
+
+def get_ingest_batcher(request: Request) -> IngestBatcher:
+    return request.app.state.ingest_batcher
+
+# Admission control: acquire() raises 429 when the endpoint is already at capacity.
+# Chat handlers acquire only once FastAPI has validated the body, so a 422 never holds a slot.
+def get_chat_limit(request: Request) -> ConcurrencyLimit:
+    return request.app.state.chat_limit
+
+async def ingest_slot(request: Request):
+    slot = request.app.state.ingest_limit.acquire()
+    try:
+        yield slot
+    finally:
+        slot.release()
+
+# --- Lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state = app.state
+    logger.info("Connecting to Ollama at %s...", OLLAMA_BASE_URL)
+
+    # One pooled client for the whole process keeps keep-alive connections to Ollama hot.
+    # Connect fails fast so the retry/breaker kicks in; reads allow for slow generations.
+    state.http = httpx.AsyncClient(
+        base_url=OLLAMA_BASE_URL,
+        http2=True,
+        timeout=httpx.Timeout(float(os.getenv("OLLAMA_TIMEOUT", "120")), connect=5.0),
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    )
+
+    # Exact-match LLM/embedding cache (Redis if REDIS_URL is set, otherwise in-process)
+    state.llm_cache = LLMCache(redis_url=os.getenv("REDIS_URL"), ttl=int(os.getenv("LLM_CACHE_TTL", "3600")))
+    # Query/chunk embeddings stay in-process; skips repeat round-trips to the embedding model
+    embedding_cache = EmbeddingCache(
+        max_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        ttl=int(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+    )
+    # Near-duplicate answer cache in front of the whole pipeline
+    semantic_cache = SemanticCache(threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")))
 
     # Initialize all engines with the sanitized URL
-    reasoning_engine = ReasoningEngine(ollama_base_url=OLLAMA_BASE_URL)
-    vector_store = VectorStoreManager(ollama_base_url=OLLAMA_BASE_URL)
-    vision_tool = VisionTool(ollama_base_url=OLLAMA_BASE_URL)
-    synthesizer = ResponseSynthesizer(ollama_base_url=OLLAMA_BASE_URL)
+    vector_store = VectorStoreManager(ollama_base_url=OLLAMA_BASE_URL, http_client=state.http, embedding_cache=embedding_cache)
+    state.engines = ChatEngines(
+        reasoning=ReasoningEngine(
+            ollama_base_url=OLLAMA_BASE_URL,
+            client=state.http,
+            reasoning_model=os.getenv("REASONING_MODEL", DEFAULT_REASONING_MODEL),
+            cache=state.llm_cache
+        ),
+        vector_store=vector_store,
+        vision=VisionTool(ollama_base_url=OLLAMA_BASE_URL, client=state.http),
+        synthesizer=ResponseSynthesizer(ollama_base_url=OLLAMA_BASE_URL, client=state.http, cache=state.llm_cache),
+        semantic_cache=semantic_cache,
+    )
+    # Concurrent /ingest calls share one embedding request and one set of index writes
+    state.ingest_batcher = IngestBatcher(vector_store)
+    state.ingest_batcher.start()
+
+    # Beyond these, requests get an immediate 429 instead of queueing behind Ollama.
+    # The ingest default matches the batcher's max_batch so a full batch can still form.
+    state.chat_limit = ConcurrencyLimit(int(os.getenv("CHAT_CONCURRENCY", "32")))
+    state.ingest_limit = ConcurrencyLimit(int(os.getenv("INGEST_CONCURRENCY", str(state.ingest_batcher.max_batch))))
+
+    # The SPA shell only changes on rebuild (which restarts the container); read it once.
+    # (bytes, etag), or None when the frontend is not built.
+    state.index_html = None
+    if os.path.exists("static/index.html"):
+        with open("static/index.html", "rb") as f:
+            content = f.read()
+        state.index_html = (content, f'"{hashlib.md5(content).hexdigest()}"')
 
-    print("[System] All modules initialized successfully.")
+    # Load every model into Ollama in the background so the first user doesn't pay for it
+    state.warmup_task = None
+    if os.getenv("WARMUP", "1") == "1":
+        state.warmup_task = asyncio.create_task(warmup_models(state.http, state.engines))
+
+    logger.info("All modules initialized successfully.")
+    try:
+        yield
+    finally:
+        if state.warmup_task is not None:
+            state.warmup_task.cancel()
+        await state.ingest_batcher.stop()
+        await state.http.aclose()
+        await state.llm_cache.close()
+
+async def warmup_models(client: httpx.AsyncClient, engines: ChatEngines):
+    """
+    Best-effort: asks Ollama to load each model (an empty /api/generate loads
+    without generating; embedding models get one tiny /api/embed). Goes through
+    the raw client, not the engines, so failures are visible here and do not
+    trip the shared circuit breaker before real traffic arrives.
+    """
+    # num_ctx must match the real calls or Ollama reloads the model on first use
+    text_options = {"num_ctx": 4096}
+    loads = {
+        engines.reasoning.reasoning_model: ("/api/generate", {"options": text_options}),
+        engines.synthesizer.default_model: ("/api/generate", {"options": text_options}),
+        engines.vision.model: ("/api/generate", {}),
+        engines.vector_store.embedding_model: ("/api/embed", {"input": "ping"}),
+    }
+
+    async def load(model: str, path: str, extra: Dict):
+        response = await client.post(f"{OLLAMA_BASE_URL}{path}", json={"model": model, "keep_alive": "30m", **extra})
+        response.raise_for_status()
+
+    results = await asyncio.gather(*(load(model, path, extra) for model, (path, extra) in loads.items()), return_exceptions=True)
+    failed = {model: repr(r) for model, r in zip(loads, results) if isinstance(r, Exception)}
+    if failed:
+        logger.warning("%d of %d model(s) failed to warm up: %s", len(failed), len(loads), failed)
+    else:
+        logger.info("Models warmed up: %s", ", ".join(loads))
+
+# --- FastAPI Setup ---
+class OrjsonResponse(JSONResponse):
+    """JSON rendered by orjson (FastAPI's own ORJSONResponse is deprecated in newer releases)."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="Agentic RAG API", version="1.0.0", default_response_class=OrjsonResponse, lifespan=lifespan)
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    return OrjsonResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+class SSESafeGZipMiddleware(GZipMiddleware):
+    """
+    Compresses JSON and the SPA shell but never the SSE routes: Starlette only
+    excludes text/event-stream from 0.46 on, and older versions buffer the
+    stream in an unflushed GzipFile, stalling tokens.
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/chat/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(SSESafeGZipMiddleware, minimum_size=500)
+
+# The built SPA is served same-origin and the Vite dev server proxies /chat, so CORS
+# only matters for other frontends; list them in CORS_ORIGINS (comma-separated).
+# max_age lets browsers cache a preflight for a day instead of repeating it.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:5173").split(",") if o.strip()]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
+)
 
 # --- Endpoints ---
-@app.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
+@app.post("/chat/stream", response_model=None)
+async def chat_stream(
+    request: ChatRequest,
+    engines: ChatEngines = Depends(get_chat_engines),
+    chat_limit: ConcurrencyLimit = Depends(get_chat_limit)
+):
+    slot = chat_limit.acquire()
+    try:
+        image_bytes = None
+        if request.image_data:
+            # JSON clients send base64 (optionally as a data URL); decode once at the edge,
+            # in a worker thread so a multi-MB image doesn't stall the event loop
+            try:
+                image_bytes = await asyncio.to_thread(base64.b64decode, request.image_data.split(",")[-1], validate=True)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="image_data is not valid base64.")
+        return run_chat(engines, slot, request.query, request.history, image_bytes)
+    except BaseException:
+        slot.release()
+        raise
+
+@app.post("/chat/stream/upload", response_model=None)
+async def chat_stream_upload(
+    query: str = Form(...),
+    history: str = Form("[]"),
+    image: UploadFile = File(...),
+    engines: ChatEngines = Depends(get_chat_engines),
+    chat_limit: ConcurrencyLimit = Depends(get_chat_limit)
+):
+    """
+    Multipart variant of /chat/stream: the image arrives as raw bytes and is
+    base64-encoded exactly once, for the Ollama request.
+    """
     try:
-        user_query = request.query
-        history = request.history
-        image_data = request.image_data
+        chat_history = _HISTORY_ADAPTER.validate_json(history)
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="history must be a JSON array of {role, content} objects.")
+    slot = chat_limit.acquire()
+    try:
+        image_bytes = await image.read()
+        return run_chat(engines, slot, query, chat_history, image_bytes or None)
+    except BaseException:
+        slot.release()
+        raise
+
+def _consume_exception(task: asyncio.Task):
+    # Marks a discarded background task's exception as retrieved (no "never retrieved" warning)
+    if not task.cancelled():
+        task.exception()
+
+def sse_response(tokens: AsyncIterator[str], slot: Slot) -> StreamingResponse:
+    # The chat slot stays taken until the stream has been fully sent (or abandoned)
+    return SlotStreamingResponse(sse_stream(tokens), slot, media_type="text/event-stream", headers=SSE_HEADERS)
+
+def _single_flight_key(user_query: str, history: List[Dict], image_bytes: Optional[bytes]) -> str:
+    # Case and spacing don't change the answer; the history and image do
+    digest = hashlib.sha256(" ".join(user_query.casefold().split()).encode())
+    digest.update(orjson.dumps(history))
+    if image_bytes:
+        digest.update(hashlib.sha256(image_bytes).digest())
+    return digest.hexdigest()
+
+def run_chat(engines: ChatEngines, slot: Slot, user_query: str, history: List[Dict], image_bytes: Optional[bytes]) -> StreamingResponse:
+    """
+    Single-flight: identical concurrent turns share one pipeline run. Later
+    callers subscribe to the first one's StreamFanout, get the tokens produced
+    so far replayed, then follow the live stream.
+    """
+    key = _single_flight_key(user_query, history, image_bytes)
+    fanout = engines.inflight.get(key)
+    if fanout is None:
+        # Dropped from the map the moment it stops accepting subscribers, so a
+        # turn being cancelled (everyone left) is never joined
+        fanout = StreamFanout(
+            _single_flight(engines, user_query, history, image_bytes),
+            on_close=lambda: engines.inflight.pop(key, None)
+        )
+        engines.inflight[key] = fanout
+    else:
+        logger.info("Joining an identical in-flight request")
+    return sse_response(fanout.subscribe(), slot)
+
+async def _single_flight(engines: ChatEngines, user_query: str, history: List[Dict], image_bytes: Optional[bytes]) -> AsyncIterator[str]:
+    tokens = await prepare_chat(engines, user_query, history, image_bytes)
+    async for token in tokens:
+        yield token
 
-        # Phase 1: Reasoning
-        if image_data:
+async def prepare_chat(engines: ChatEngines, user_query: str, history: List[Dict], image_bytes: Optional[bytes]) -> AsyncIterator[str]:
+    """Runs phases 0-2 and returns the answer's token stream."""
+    reasoning_engine, vector_store, synthesizer = engines.reasoning, engines.vector_store, engines.synthesizer
+    semantic_cache = engines.semantic_cache
+    try:
+        # Phase 0: Semantic cache. Only standalone turns qualify: the key is the
+        # query alone, so a follow-up ("and its price?") must not match another chat.
+        query_vec = None
+        if not image_bytes and not any(m.get("role") == "user" for m in history):
+            query_vec = await vector_store.embed(user_query)
+            cached = semantic_cache.lookup(query_vec) if query_vec else None
+            if cached is not None:
+                logger.info("Semantic cache hit (%s)", cached.intent)
+                return text_stream(cached.response)
+
+        # Phase 1: Reasoning (intent + standalone query rewrite in one call).
+        # SEARCH is the common case, so retrieval for the raw query starts
+        # alongside it and is cancelled if the analysis goes another way.
+        search_query = user_query
+        speculative_search = None
+        if image_bytes:
             intent = IntentType.VISION_QA
-            print(f"[Log] Intent detected: {intent} (Image Uploaded)")
+            logger.info("Intent detected: %s (image uploaded)", intent)
         else:
+            speculative_search = asyncio.create_task(vector_store.search(user_query, top_k=3))
+            speculative_search.add_done_callback(_consume_exception)
             analysis = await reasoning_engine.analyze_query(user_query, history)
             intent = analysis.intent
-            print(f"[Log] Intent detected: {intent}")
+            search_query = analysis.rewritten_query or user_query
+            logger.info("Intent detected: %s", intent)
+            if intent != IntentType.SEARCH or search_query != user_query:
+                speculative_search.cancel()
+                speculative_search = None
 
         # Phase 2: Tool Execution
         tool_output = ""
-        if intent == IntentType.VISION_QA and image_data:
-            tool_output = await vision_tool.analyze_image(image_data, prompt=user_query)
+        if intent == IntentType.VISION_QA and image_bytes:
+            tool_output = await engines.vision.analyze_image(image_bytes, prompt=user_query)
 
         elif intent == IntentType.SEARCH:
-            tool_output = await vector_store.search(user_query, top_k=3)
+            tool_output = await (speculative_search or vector_store.search(search_query, top_k=3))
 
         elif intent == IntentType.CALCULATE:
              tool_output = "Calculator tool not yet implemented."
 
         # Phase 3: Aggregation (Streaming)
-        return StreamingResponse(
-            synthesizer.generate_response_stream(
-                user_query=user_query,
-                tool_output=tool_output,
-                intent=intent,
-                chat_history=history
-            ),
-            media_type="text/event-stream"
+        tokens = synthesizer.generate_response_stream(
+            user_query=user_query,
+            tool_output=tool_output,
+            intent=intent,
+            chat_history=history
         )
+        if query_vec:
+            tokens = semantic_cache.record(query_vec, intent, tool_output, tokens)
+        return tokens
 
     except Exception as e:
-        print(f"[Error] Processing failed: {e}")
+        logger.exception("Processing failed: %s", e)
         # Return a simplified error message to the frontend instead of crashing 500
-        return StreamingResponse(
-            iter([f"System Error: {str(e)}"]),
-            media_type="text/event-stream"
-        )
+        return text_stream(f"System Error: {str(e)}")
 
-@app.post("/ingest")
-async def ingest_document(request: IngestRequest):
+@app.post("/ingest", response_model=None)
+async def ingest_document(
+    request: IngestRequest,
+    ingest_batcher: IngestBatcher = Depends(get_ingest_batcher),
+    engines: ChatEngines = Depends(get_chat_engines),
+    slot: Slot = Depends(ingest_slot)
+):
     try:
-        await vector_store.add_documents(
-            documents=[request.text_content],
-            metadatas=[request.metadata]
-        )
+        await ingest_batcher.submit(request.text_content, request.metadata)
+        engines.semantic_cache.invalidate_search()
         return {"status": "success", "message": "Document indexed."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- Static Files & Frontend Serving ---
+class HashedAssetFiles(StaticFiles):
+    """
+    Vite puts a content hash in every asset name (index-3f9a1c2b.js), so a given
+    URL never changes content: let browsers and CDNs keep it for a year without
+    revalidating. Unhashed files keep Starlette's default ETag handling.
+    """
+    HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.(js|mjs|css|woff2?|ttf|svg|png|jpe?g|gif|webp|avif|ico)$")
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if self.HASHED_NAME.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# In production a front proxy can serve /assets directly (see README); this is the fallback
 if os.path.exists("static"):
-    app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
+    app.mount("/assets", HashedAssetFiles(directory="static/assets"), name="assets")
 
 @app.get("/{catchall:path}")
-async def read_index(catchall: str):
+async def read_index(catchall: str, request: Request):
+    index_html = request.app.state.index_html
+    if index_html is not None:
+        content, etag = index_html
+        # no-cache: browsers revalidate every load, but an unchanged shell costs a bodiless 304
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return Response(content=content, media_type="text/html", headers=headers)
     if os.path.exists("static/index.html"):
         return FileResponse("static/index.html")
     return {"error": "Frontend not built or static files missing"}
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8085, reload=True)
\ No newline at end of file
+    # Caches and in-flight maps are per worker. Chroma's PersistentClient is not
+    # multi-process safe, so keep one worker unless Chroma runs as a server.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8085")),
+        # "auto" picks uvloop/httptools when installed and falls back to asyncio/h11
+        # otherwise (uvloop has no Windows build); the Dockerfile pins them explicitly
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=bool(int(os.getenv("RELOAD", "0")))
+    )
\ No newline at end of file
@@ -0,0 +1,45 @@
+import asyncio
+from typing import Dict
+
+import pytest
+
+from core.coalesce import StreamFanout
+
+async def _slow_tokens(n: int = 5):
+    for i in range(n):
+        yield f"t{i} "
+        await asyncio.sleep(0.01)
+
+def test_no_join_while_last_subscriber_cancels():
+    """A caller arriving while the source is being cancelled must start fresh, not get a truncated run."""
+    async def scenario():
+        inflight: Dict[str, StreamFanout] = {}
+
+        def get_or_start() -> StreamFanout:
+            fanout = inflight.get("k")
+            if fanout is None:
+                fanout = StreamFanout(_slow_tokens(), on_close=lambda: inflight.pop("k", None))
+                inflight["k"] = fanout
+            return fanout
+
+        first_fanout = get_or_start()
+        first = first_fanout.subscribe()
+        assert await first.__anext__() == "t0 "
+        await first.aclose()
+
+        second_fanout = get_or_start()
+        assert second_fanout is not first_fanout
+        return [token async for token in second_fanout.subscribe()]
+
+    assert asyncio.run(scenario()) == ["t0 ", "t1 ", "t2 ", "t3 ", "t4 "]
+
+def test_cancelled_source_ends_subscribers_with_error():
+    async def scenario():
+        fanout = StreamFanout(_slow_tokens())
+        subscriber = fanout.subscribe()
+        await subscriber.__anext__()
+        fanout.cancel()
+        return [token async for token in subscriber]
+
+    with pytest.raises(RuntimeError, match="cancelled"):
+        asyncio.run(scenario())
@@ -0,0 +1,33 @@
+import asyncio
+import uuid
+
+import chromadb
+import httpx
+import orjson
+
+import core.tools
+from core.tools import VectorStoreManager
+
+def test_concurrent_query_embeds_share_one_request(monkeypatch):
+    """Identical uncached query texts from concurrent callers cost one /api/embed call; hits cost none."""
+    ephemeral = chromadb.EphemeralClient()
+    monkeypatch.setattr(core.tools.chromadb, "PersistentClient", lambda path: ephemeral)
+    calls = []
+
+    async def fake_ollama(request: httpx.Request) -> httpx.Response:
+        texts = orjson.loads(request.content)["input"]
+        calls.append(texts)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"embeddings": [[float(len(t))] for t in texts]})
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(fake_ollama)) as client:
+            store = VectorStoreManager("http://ollama", client, collection_name=f"test_{uuid.uuid4().hex}")
+            first = await asyncio.gather(*[store.embed("same new query text") for _ in range(5)])
+            second = await store._get_embeddings_batch(["same new query text", "other"])
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == [[19.0]] * 5
+    assert second == [[19.0], [5.0]]
+    assert calls == [["same new query text"], ["other"]]
@@ -0,0 +1,61 @@
+import asyncio
+import hashlib
+import uuid
+
+import chromadb
+import httpx
+import orjson
+
+import core.tools
+from core.ingest_batcher import IngestBatcher
+from core.tools import VectorStoreManager
+
+def _vector(text: str):
+    return [b / 255 for b in hashlib.sha256(text.encode()).digest()[:8]]
+
+def _fake_ollama(request: httpx.Request) -> httpx.Response:
+    """Embeds anything except text containing "poison" (400, so nothing is retried)."""
+    body = orjson.loads(request.content)
+    if request.url.path == "/api/embeddings":
+        if "poison" in body["prompt"]: return httpx.Response(400)
+        return httpx.Response(200, json={"embedding": _vector(body["prompt"])})
+    if any("poison" in t for t in body["input"]): return httpx.Response(400)
+    return httpx.Response(200, json={"embeddings": [_vector(t) for t in body["input"]]})
+
+def _run_batcher(monkeypatch, scenario):
+    ephemeral = chromadb.EphemeralClient()
+    monkeypatch.setattr(core.tools.chromadb, "PersistentClient", lambda path: ephemeral)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(_fake_ollama)) as client:
+            store = VectorStoreManager("http://ollama", client, collection_name=f"test_{uuid.uuid4().hex}")
+            batcher = IngestBatcher(store)
+            batcher.start()
+            try:
+                results = await scenario(batcher)
+            finally:
+                await batcher.stop()
+            return results, sorted(store.collection.get()["documents"])
+
+    return asyncio.run(run())
+
+def test_mixed_batch_keeps_every_document(monkeypatch):
+    """An empty document in a batch must not shift later chunk ids onto existing ones."""
+    async def scenario(batcher):
+        results = await asyncio.gather(batcher.submit("", {"source": "empty"}), batcher.submit("alpha doc", {"source": "a"}), return_exceptions=True)
+        results.append(await batcher.submit("beta doc", {"source": "b"}))
+        return results
+
+    (empty, alpha, beta), documents = _run_batcher(monkeypatch, scenario)
+    assert isinstance(empty, RuntimeError)
+    assert alpha is None and beta is None
+    assert documents == ["alpha doc", "beta doc"]
+
+def test_document_without_embeddings_fails_only_its_own_request(monkeypatch):
+    async def scenario(batcher):
+        return await asyncio.gather(batcher.submit("poison doc", {"source": "p"}), batcher.submit("alpha doc", {"source": "a"}), return_exceptions=True)
+
+    (poison, alpha), documents = _run_batcher(monkeypatch, scenario)
+    assert isinstance(poison, RuntimeError)
+    assert alpha is None
+    assert documents == ["alpha doc"]
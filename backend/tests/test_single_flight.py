@@ -0,0 +1,47 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+import main
+from core.limits import ConcurrencyLimit
+
+async def _events(body):
+    return [orjson.loads(chunk[len(b"data: "):]) async for chunk in body if chunk.startswith(b"data: ")]
+
+@pytest.mark.parametrize("ticks", range(6))
+def test_turn_joining_while_identical_one_is_abandoned_gets_full_answer(monkeypatch, ticks):
+    """Whenever the second identical turn arrives relative to the first client leaving, it never gets a truncated stream."""
+    runs = []
+
+    async def fake_prepare_chat(engines, user_query, history, image_bytes):
+        runs.append(user_query)
+
+        async def tokens():
+            for i in range(5):
+                yield f"t{i} "
+                await asyncio.sleep(0.01)
+        return tokens()
+
+    monkeypatch.setattr(main, "prepare_chat", fake_prepare_chat)
+
+    async def scenario():
+        engines = SimpleNamespace(inflight={})
+        limit = ConcurrencyLimit(2)
+
+        first = main.run_chat(engines, limit.acquire(), "same question", [], None).body_iterator
+        assert b"t0" in await first.__anext__()
+        # The first client disconnects; the identical turn arrives `ticks` loop iterations later
+        await first.aclose()
+        for _ in range(ticks):
+            await asyncio.sleep(0)
+        second = main.run_chat(engines, limit.acquire(), "same question", [], None).body_iterator
+        return await _events(second), engines.inflight
+
+    events, inflight = asyncio.run(scenario())
+    assert len(runs) in (1, 2)
+    assert "".join(e.get("token", "") for e in events) == "t0 t1 t2 t3 t4 "
+    assert not any("error" in e for e in events)
+    assert events[-1] == {"done": True}
+    assert inflight == {}